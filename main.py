@@ -1,8 +1,17 @@
 # Core Python libraries
 import os
+import re
+import asyncio
+import hashlib
+import functools
+import json
+import queue
 import logging # Import the logging module
+from logging.handlers import QueueHandler, QueueListener
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from typing import Literal
+from typing import AsyncIterator, Callable, Literal
 
 # --- Load Environment Variables ---
 load_dotenv()
@@ -13,17 +22,47 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(name)s - %(message)s', # Define log message format
     datefmt='%Y-%m-%d %H:%M:%S' # Define date format
 )
+
+# While the app is running, the root logger's handlers sit behind a QueueListener on a background
+# thread, so request handlers only enqueue records instead of writing to stderr themselves.
+_log_listener: "Optional[QueueListener]" = None
+_direct_log_handlers: "list[logging.Handler]" = []
+
+def start_log_listener() -> None:
+    global _log_listener, _direct_log_handlers
+    if _log_listener is not None:
+        return
+    root_logger = logging.getLogger()
+    _direct_log_handlers = root_logger.handlers[:]
+    log_queue = queue.SimpleQueue()
+    _log_listener = QueueListener(log_queue, *_direct_log_handlers, respect_handler_level=True)
+    root_logger.handlers = [QueueHandler(log_queue)]
+    _log_listener.start()
+
+def stop_log_listener() -> None:
+    """Restores the original root handlers and flushes queued records. Safe to call repeatedly."""
+    global _log_listener
+    if _log_listener is None:
+        return
+    logging.getLogger().handlers = _direct_log_handlers
+    _log_listener.stop()
+    _log_listener = None
+
 # Get a logger instance for this module
 logger = logging.getLogger(__name__)
 
 # --- FastAPI & Pydantic ---
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, field_validator
 from typing import Optional
 
 # --- Google Gemini ---
 import google.generativeai as genai
 
+# --- Numerics (semantic cache) ---
+import numpy as np
+
 # --- Access and Configure API Keys ---
 gemini_api_key = os.getenv("GEMINI_API_KEY")
 
@@ -35,15 +74,171 @@ else:
     logger.warning("GEMINI_API_KEY not found in environment variables.")
     logger.warning("The application will not be able to contact the Gemini API.")
 
-# === LLM Interaction Function ===
-async def call_gemini_api(prompt: str) -> Optional[str]:
-    """Calls the Gemini API, logging info and errors."""
-    if not gemini_api_key:
-        logger.error("Cannot call Gemini API: API key is not configured.") # Use logger.error
+# Built once and shared by all requests; None when the API key is missing
+_MODEL = genai.GenerativeModel('gemini-2.0-flash') if gemini_api_key else None
+
+# --- Response Cache ---
+# Exact-match LRU cache of LLM responses, keyed by SHA-256 of model name + final prompt.
+# Identical prompts skip the network round-trip entirely. Off by default; set CACHE_ENABLED=1 to enable.
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "0") == "1"
+MAX_ENTRIES = 1024
+_RESPONSE_CACHE: "OrderedDict[str, str]" = OrderedDict()
+
+# --- Semantic Cache ---
+# Near-match cache: requests whose topic/context embeddings are close enough (cosine similarity)
+# to an earlier request of the same content type reuse its response. Set SEMANTIC_CACHE=1 to enable.
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH") # Optional .npz file to persist entries across restarts
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_MAX_ENTRIES = 10000 # Per content type
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+class _EmbeddingRing:
+    """Fixed-capacity ring buffer of embeddings and responses; when full, the oldest entry is overwritten."""
+
+    def __init__(self, capacity: int, dim: int):
+        self.matrix = np.zeros((capacity, dim), dtype=np.float32)
+        self.responses: list[Optional[str]] = [None] * capacity
+        self.size = 0
+        self.next_index = 0
+
+    def add(self, embedding: np.ndarray, response: str) -> None:
+        self.matrix[self.next_index] = embedding # In-place row write, no reallocation
+        self.responses[self.next_index] = response
+        self.next_index = (self.next_index + 1) % len(self.responses)
+        self.size = min(self.size + 1, len(self.responses))
+
+    @classmethod
+    def restore(cls, capacity: int, rows: np.ndarray, responses: list[str], next_index: int) -> "_EmbeddingRing":
+        """Rebuilds a ring from the filled rows and responses written by SemanticCache.save."""
+        ring = cls(capacity, rows.shape[1])
+        size = min(len(responses), capacity)
+        ring.matrix[:size] = rows[:size]
+        ring.responses[:size] = responses[:size]
+        ring.size = size
+        ring.next_index = next_index % capacity if size == capacity else size
+        return ring
+
+class SemanticCache:
+    """Stores L2-normalized embeddings and their responses, partitioned by content type."""
+
+    def __init__(self, threshold: float, max_entries: int, path: Optional[str] = None):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.path = path
+        self._entries: dict[str, _EmbeddingRing] = {} # content_type -> ring of up to max_entries rows
+        if path and os.path.exists(path):
+            try:
+                self._load(path)
+                logger.info("Loaded semantic cache from '%s'.", path)
+            except Exception as e:
+                logger.warning("Could not load semantic cache from '%s': %s - %s", path, type(e).__name__, e)
+
+    def lookup(self, content_type: str, embedding: np.ndarray) -> Optional[str]:
+        """Returns the cached response most similar to `embedding`, if above the threshold."""
+        ring = self._entries.get(content_type)
+        if ring is None or ring.size == 0:
+            return None
+        sims = ring.matrix[:ring.size] @ embedding # Cosine similarity, since all rows are normalized
+        best = int(np.argmax(sims))
+        if sims[best] > self.threshold:
+            logger.info("Semantic cache hit (similarity %.3f).", sims[best])
+            return ring.responses[best]
+        return None
+
+    def add(self, content_type: str, embedding: np.ndarray, response: str) -> None:
+        ring = self._entries.get(content_type)
+        if ring is None:
+            ring = self._entries[content_type] = _EmbeddingRing(self.max_entries, embedding.shape[0])
+        ring.add(embedding, response)
+
+    # The cache file is an .npz archive of plain arrays (no pickled objects): one "matrix_<type>" array
+    # of filled embedding rows per content type, plus a JSON "meta" string with responses and write index.
+    def _load(self, path: str) -> None:
+        entries = {}
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            for content_type, info in meta.items():
+                entries[content_type] = _EmbeddingRing.restore(
+                    self.max_entries, data[f"matrix_{content_type}"], info["responses"], info["next_index"]
+                )
+        self._entries = entries
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        arrays = {}
+        meta = {}
+        for content_type, ring in self._entries.items():
+            arrays[f"matrix_{content_type}"] = ring.matrix[:ring.size]
+            meta[content_type] = {"responses": ring.responses[:ring.size], "next_index": ring.next_index}
+        arrays["meta"] = np.array(json.dumps(meta))
+        try:
+            with open(self.path, "wb") as f: # A file object keeps np.savez from appending ".npz" to the path
+                np.savez(f, **arrays)
+            logger.info("Saved semantic cache to '%s'.", self.path)
+        except Exception as e:
+            logger.error("Could not save semantic cache to '%s': %s - %s", self.path, type(e).__name__, e)
+
+_SEMANTIC_CACHE = (
+    SemanticCache(SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_PATH)
+    if SEMANTIC_CACHE_ENABLED else None
+)
+
+# === LLM Interaction Functions ===
+def _prompt_key(model_name: str, prompt: str) -> str:
+    """Returns the key identifying a prompt for the response cache and in-flight coalescing."""
+    return hashlib.sha256(f"{model_name}\x00{prompt}".encode()).hexdigest()
+
+def _response_cache_get(prompt_key: str) -> Optional[str]:
+    if not CACHE_ENABLED:
         return None
+    cached = _RESPONSE_CACHE.get(prompt_key)
+    if cached is not None:
+        _RESPONSE_CACHE.move_to_end(prompt_key)
+        logger.info("Response cache hit; skipping Gemini API call.") # logger.info
+    return cached
+
+def _response_cache_put(prompt_key: str, text: str) -> None:
+    if not CACHE_ENABLED:
+        return
+    _RESPONSE_CACHE[prompt_key] = text
+    if len(_RESPONSE_CACHE) > MAX_ENTRIES:
+        _RESPONSE_CACHE.popitem(last=False) # Evict least recently used
+
+# Tasks of Gemini calls currently awaiting a response, keyed by prompt key. Concurrent requests
+# for an identical prompt await the same task instead of each issuing their own API call.
+_IN_FLIGHT: dict[str, asyncio.Task] = {}
+
+async def call_gemini_api(prompt: str, prompt_key: Optional[str] = None) -> Optional[str]:
+    """Calls the Gemini API, logging info and errors.
+
+    Responses are not added to the response cache here; the caller does that once the text parses.
+    """
+    model = _MODEL
+
+    prompt_key = prompt_key or _prompt_key(model._model_name, prompt)
+    cached = _response_cache_get(prompt_key)
+    if cached is not None:
+        return cached
+
+    task = _IN_FLIGHT.get(prompt_key)
+    if task is None:
+        # The call runs in its own task, so it isn't tied to the lifetime of the request that started it
+        task = asyncio.create_task(_generate_content(model, prompt))
+        _IN_FLIGHT[prompt_key] = task
+        task.add_done_callback(functools.partial(_clear_in_flight, prompt_key))
+    else:
+        logger.info("Identical Gemini request already in flight; awaiting its response.") # logger.info
+    return await asyncio.shield(task) # A cancelled caller stops waiting without cancelling the shared call
+
+def _clear_in_flight(prompt_key: str, task: asyncio.Task) -> None:
+    if _IN_FLIGHT.get(prompt_key) is task:
+        del _IN_FLIGHT[prompt_key]
 
-    model = genai.GenerativeModel('gemini-2.0-flash')
-    logger.info(f"Sending request to Gemini model '{model._model_name}'...") # logger.info
+async def _generate_content(model: genai.GenerativeModel, prompt: str) -> Optional[str]:
+    """Sends a single prompt to Gemini, returning the response text or None."""
+    logger.info("Sending request to Gemini model '%s'...", model._model_name) # logger.info
     # logger.debug(f"Full prompt being sent:\n{prompt}") # Example of DEBUG level
 
     try:
@@ -55,128 +250,199 @@ async def call_gemini_api(prompt: str) -> Optional[str]:
             return response.text
         else:
             # Log response issues as warnings or errors depending on severity
-            logger.warning(f"Gemini response OK but contained no text. Feedback: {response.prompt_feedback}")
+            logger.warning("Gemini response OK but contained no text. Feedback: %s", response.prompt_feedback)
             return None
 
     except Exception as e:
         # Log exceptions with error level
-        logger.error(f"Exception during Gemini API call: {type(e).__name__} - {e}", exc_info=True)
+        logger.error("Exception during Gemini API call: %s - %s", type(e).__name__, e, exc_info=True)
         # exc_info=True adds traceback information to the log, very useful!
         return None
 
+async def stream_gemini(prompt: str, prompt_key: str, on_complete: Optional[Callable[[str], None]] = None) -> AsyncIterator[str]:
+    """Streams the Gemini response text chunk by chunk, logging info and errors.
+
+    Yields nothing if the call fails before any text arrives. `on_complete` receives the full text
+    only if a fresh stream finishes without errors.
+    """
+    model = _MODEL
+
+    cached = _response_cache_get(prompt_key)
+    if cached is not None:
+        yield cached
+        return
+
+    logger.info("Streaming request to Gemini model '%s'...", model._model_name)
+    chunks = []
+    try:
+        response = await model.generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            if chunk.text:
+                chunks.append(chunk.text)
+                yield chunk.text
+    except Exception as e:
+        # Headers may already be sent, so the client just sees a truncated body
+        logger.error("Exception during Gemini streaming call: %s - %s", type(e).__name__, e, exc_info=True)
+        return
+
+    logger.info("Finished streaming response from Gemini API.")
+    if chunks and on_complete is not None:
+        on_complete("".join(chunks))
+
+async def embed_text(text: str) -> Optional[np.ndarray]:
+    """Returns the L2-normalized Gemini embedding of `text`, or None on failure."""
+    try:
+        result = await genai.embed_content_async(model=EMBEDDING_MODEL, content=text)
+    except Exception as e:
+        logger.error("Exception during Gemini embedding call: %s - %s", type(e).__name__, e, exc_info=True)
+        return None
+    embedding = np.asarray(result["embedding"], dtype=np.float32)
+    norm = np.linalg.norm(embedding)
+    return embedding / norm if norm else None
+
+async def generate_with_semantic_cache(
+    prompt: str, prompt_key: str, content_type: str, topic: str, context: str
+) -> tuple[Optional[str], Optional[np.ndarray]]:
+    """Calls the Gemini API, reusing a near-identical earlier response when SEMANTIC_CACHE=1.
+
+    Returns the response text and, for a fresh response, the embedding to store with it in the
+    semantic cache; the caller adds it only once the text parses.
+    """
+    if _SEMANTIC_CACHE is None:
+        return await call_gemini_api(prompt, prompt_key), None
+
+    # Exact-cache hits and in-flight duplicates are answered by call_gemini_api without an embedding round-trip
+    if prompt_key in _IN_FLIGHT or (CACHE_ENABLED and prompt_key in _RESPONSE_CACHE):
+        return await call_gemini_api(prompt, prompt_key), None
+
+    # Embed only the variable part of the prompt; the shared template would dominate the similarity.
+    embedding = await embed_text(f"{topic}\n{context}")
+    if embedding is not None:
+        cached = _SEMANTIC_CACHE.lookup(content_type, embedding)
+        if cached is not None:
+            return cached, None
+
+    return await call_gemini_api(prompt, prompt_key), embedding
+
 # === Parsing Functions ===
+def _log_raw_text_snippet(raw_text: str, prefix: str = "") -> None:
+    """Logs the start of the raw LLM output after a parsing failure."""
+    if logger.isEnabledFor(logging.ERROR): # Don't slice the snippet if it won't be emitted
+        logger.error("%sRaw Text Snippet:\n%s...", prefix, raw_text[:200])
+
+# MCQ line handlers, dispatched on the label before the first colon (e.g. "Question", "A").
+# Each handler stores the stripped text after the colon into the parse state.
+def _set_question(state: dict, value: str) -> None:
+    state["question_text"] = value
+
+def _set_option(letter: str):
+    def handler(state: dict, value: str) -> None:
+        state["options"][letter] = value
+    return handler
+
+def _set_correct_answer(state: dict, value: str) -> None:
+    state["correct_answer_letter"] = value.upper()
+
+_MCQ_HANDLERS = {
+    "Question": _set_question,
+    "A": _set_option("A"),
+    "B": _set_option("B"),
+    "C": _set_option("C"),
+    "D": _set_option("D"),
+    "Correct Answer": _set_correct_answer,
+}
+
+# Option letter -> index into the options list
+_LETTER_IDX = {"A": 0, "B": 1, "C": 2, "D": 3}
+
 def parse_mcq_output(raw_text: str) -> Optional[dict]:
     """Parses MCQ output, logging info and errors."""
-    question_text = None
-    options = []
-    correct_answer_letter = None
-    temp_options = {}
-    lines = raw_text.strip().split('\n')
-    logger.info(f"Attempting to parse MCQ from {len(lines)} lines...") # logger.info
+    state = {"question_text": None, "options": {}, "correct_answer_letter": None}
+    lines = raw_text.splitlines() # Blank lines (incl. leading/trailing) are skipped below
+    logger.info("Attempting to parse MCQ from %d lines...", len(lines)) # logger.info
 
     for line in lines:
         line = line.strip()
         if not line: continue
 
-        try:
-            # Using logger.debug for very fine-grained parsing steps might be excessive for INFO level
-            # Stick to INFO for major parts found, ERROR for failures
-            if line.startswith("Question:"):
-                question_text = line.split(":", 1)[1].strip()
-            elif line.startswith("A:"): temp_options['A'] = line.split(":", 1)[1].strip()
-            elif line.startswith("B:"): temp_options['B'] = line.split(":", 1)[1].strip()
-            elif line.startswith("C:"): temp_options['C'] = line.split(":", 1)[1].strip()
-            elif line.startswith("D:"): temp_options['D'] = line.split(":", 1)[1].strip()
-            elif line.startswith("Correct Answer:"): correct_answer_letter = line.split(":", 1)[1].strip().upper()
-        except IndexError:
-            logger.warning(f"Could not parse MCQ line: '{line}' - missing text after colon?")
-            continue
-
-    if question_text and len(temp_options) == 4 and correct_answer_letter in ['A', 'B', 'C', 'D']:
-        options = [temp_options.get('A'), temp_options.get('B'), temp_options.get('C'), temp_options.get('D')]
-        if None in options:
-             logger.error(f"MCQ Parsing Error: Missing one of the options A, B, C, D. Found: {temp_options}")
-             logger.error(f"Raw Text Snippet:\n{raw_text[:200]}...")
-             return None
-        correct_answer_index = ord(correct_answer_letter) - ord('A')
+        # One C-level scan per line instead of a chain of startswith checks
+        key, sep, rest = line.partition(":")
+        handler = _MCQ_HANDLERS.get(key) if sep else None
+        if handler:
+            handler(state, rest.strip())
+
+    question_text = state["question_text"]
+    temp_options = state["options"]
+    correct_answer_letter = state["correct_answer_letter"]
+
+    if question_text and len(temp_options) == 4 and correct_answer_letter in _LETTER_IDX:
+        # Only the A-D handlers write options, so four entries means all four letters are present
+        options = [temp_options['A'], temp_options['B'], temp_options['C'], temp_options['D']]
+        correct_answer_index = _LETTER_IDX[correct_answer_letter]
         logger.info("Successfully parsed all MCQ components.") # logger.info
         return { "type": "multiple_choice_question", "question_text": question_text, "options": options, "correct_answer_index": correct_answer_index }
     else:
         # Use logger.error for parsing failures
         logger.error("MCQ Parsing Error: Failed to find all required components.")
-        logger.error(f"  > Question found: {'Yes' if question_text else 'No'}")
-        logger.error(f"  > Options found: {len(temp_options)}/4 {list(temp_options.keys())}")
-        logger.error(f"  > Correct Answer letter found: {correct_answer_letter if correct_answer_letter else 'No'}")
-        logger.error(f"  > Raw Text Snippet:\n{raw_text[:200]}...")
+        logger.error("  > Question found: %s", 'Yes' if question_text else 'No')
+        logger.error("  > Options found: %d/4 %s", len(temp_options), list(temp_options))
+        logger.error("  > Correct Answer letter found: %s", correct_answer_letter or "No")
+        _log_raw_text_snippet(raw_text, prefix="  > ")
         return None
 
+# Quiz title on the first non-blank line, and the question header lines: any line whose first
+# word starts with a digit and contains a period, e.g. "1.", "2. (Harder)", "3. Question 3"
+_QUIZ_TITLE = re.compile(r"\s*Quiz Title:(.*)")
+_QUIZ_QUESTION_SPLIT = re.compile(r"(?m)^[ \t]*\d\S*\..*$")
+
 def parse_quiz_output(raw_text: str) -> Optional[dict]:
     """Parses Quiz output, logging info and errors."""
-    title = None
-    questions = []
-    current_question_lines = []
-    lines = raw_text.strip().split('\n')
     expected_questions = 3
-    logger.info(f"Attempting to parse Quiz from {len(lines)} lines...") # logger.info
+    logger.info("Attempting to parse Quiz from %d characters...", len(raw_text)) # logger.info
 
     # --- Find Title ---
-    first_line = lines[0].strip() if lines else ""
-    if first_line.startswith("Quiz Title:"):
-        try:
-            title = first_line.split(":", 1)[1].strip()
-            logger.info(f"Found Quiz Title: {title}") # logger.info
-            lines = lines[1:]
-        except IndexError:
-             logger.error("Quiz Parsing Error: Found 'Quiz Title:' but no text after it.") # logger.error
-             logger.error(f"Raw Text Snippet:\n{raw_text[:200]}...")
-             return None
+    title_match = _QUIZ_TITLE.match(raw_text)
+    if title_match:
+        title = title_match.group(1).strip()
+        logger.info("Found Quiz Title: %s", title) # logger.info
     else:
         logger.error("Quiz Parsing Error: 'Quiz Title:' not found on the first line.") # logger.error
-        logger.error(f"Raw Text Snippet:\n{raw_text[:200]}...")
+        _log_raw_text_snippet(raw_text)
         return None
 
-    # --- Find and Parse Questions ---
-    question_count = 0
-    for line in lines:
-        line_stripped = line.strip()
-        if not line_stripped: continue
-
-        if line_stripped and line_stripped[0].isdigit() and '.' in line_stripped.split()[0]:
-            question_count += 1
-            if current_question_lines:
-                logger.info(f"Processing collected lines for quiz question block #{question_count-1}...") # logger.info
-                question_block = "\n".join(current_question_lines)
-                parsed_mcq = parse_mcq_output(question_block) # Reuses MCQ parsing & logging
-                if parsed_mcq:
-                    questions.append(parsed_mcq)
-                else:
-                    logger.error(f"Quiz Parsing Error: Failed to parse question block #{question_count-1}.") # logger.error
-                    # Raw block snippet logged by parse_mcq_output failure
-                    return None
-                current_question_lines = []
-            # logger.debug(f"Detected start of question {question_count}: '{line_stripped}'") # DEBUG
-        else:
-            current_question_lines.append(line)
+    # --- Split into Question Blocks ---
+    # One regex pass over the body; text before "1." is normally just blank lines and is dropped
+    body = raw_text[title_match.end():]
+    question_blocks = [block for block in _QUIZ_QUESTION_SPLIT.split(body) if block.strip()]
+    if len(question_blocks) != expected_questions:
+        logger.error("Quiz Parsing Error: Found %d questions, but expected %d.", len(question_blocks), expected_questions) # logger.error
+        _log_raw_text_snippet(raw_text)
+        return None
 
-    # --- Parse the Last Collected Question ---
-    if current_question_lines:
-        logger.info(f"Processing collected lines for the last quiz question block...") # logger.info
-        question_block = "\n".join(current_question_lines)
-        parsed_mcq = parse_mcq_output(question_block)
+    # --- Parse Questions ---
+    questions = []
+    for block_number, question_block in enumerate(question_blocks, start=1):
+        logger.info("Processing quiz question block #%d...", block_number) # logger.info
+        parsed_mcq = parse_mcq_output(question_block) # Reuses MCQ parsing & logging
         if parsed_mcq:
             questions.append(parsed_mcq)
         else:
-            logger.error(f"Quiz Parsing Error: Failed to parse last question block.") # logger.error
+            logger.error("Quiz Parsing Error: Failed to parse question block #%d.", block_number) # logger.error
             # Raw block snippet logged by parse_mcq_output failure
             return None
 
-    # --- Final Validation ---
-    if len(questions) == expected_questions:
-        logger.info(f"Successfully parsed Quiz Title and {len(questions)} questions.") # logger.info
-        return { "type": "quiz", "title": title, "questions": questions }
+    logger.info("Successfully parsed Quiz Title and %d questions.", len(questions)) # logger.info
+    return { "type": "quiz", "title": title, "questions": questions }
+
+def parse_paragraph_output(raw_text: str) -> Optional[dict]:
+    """Parses paragraph output, logging info and errors."""
+    logger.info("Parsing paragraph output.")
+    content = raw_text.strip()
+    if content:
+        logger.info("Successfully parsed paragraph.")
+        return {"type": "paragraph", "content": content}
     else:
-        logger.error(f"Quiz Parsing Error: Found {len(questions)} questions, but expected {expected_questions}.") # logger.error
-        logger.error(f"Raw Text Snippet:\n{raw_text[:200]}...")
+        logger.error("Paragraph Parsing Error: LLM returned empty text after stripping.")
         return None
 
 
@@ -263,15 +529,59 @@ QUIZ_PROMPT_TEMPLATE = """**Role:** You are an AI instructional designer expert
 *   Ensure each numbered block (1, 2, 3) contains *only* the question text formatted according to the MCQ format rules.
 """
 
+# --- Prompt Template and Parser per Content Type ---
+def _split_template(template: str) -> tuple[str, str, str]:
+    """Splits a template into the fragments around its {topic} and {context} slots."""
+    prefix, rest = template.split("{topic}", 1)
+    middle, suffix = rest.split("{context}", 1)
+    return prefix, middle, suffix
+
+# Templates are split once at import, so building a prompt is a plain join (no format-spec parsing)
+_PROMPTS = {
+    "paragraph": _split_template(PARAGRAPH_PROMPT_TEMPLATE),
+    "multiple_choice_question": _split_template(MCQ_PROMPT_TEMPLATE),
+    "quiz": _split_template(QUIZ_PROMPT_TEMPLATE),
+}
+_PARSERS = {
+    "paragraph": parse_paragraph_output,
+    "multiple_choice_question": parse_mcq_output,
+    "quiz": parse_quiz_output,
+}
+
+
+def _build_prompt(content_type: str, topic: str, context: str) -> str:
+    """Fills the content type's prompt template with the topic and context."""
+    prefix, middle, suffix = _PROMPTS[content_type]
+    return "".join((prefix, topic, middle, context, suffix))
 
 
 # --- FastAPI Application Code ---
-app = FastAPI(title="AI Content Generation Service", version="0.1.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_log_listener()
+    try:
+        yield
+    finally:
+        if _SEMANTIC_CACHE is not None:
+            _SEMANTIC_CACHE.save()
+        stop_log_listener()
+
+# orjson serializes the parsed content dicts considerably faster than the stdlib json module
+app = FastAPI(title="AI Content Generation Service", version="0.1.0", default_response_class=ORJSONResponse, lifespan=lifespan)
+
+DEFAULT_CONTEXT = "None provided." # Referenced by the prompt templates' instructions
 
 class ContentRequest(BaseModel):
     topic: str
     content_type: Literal["paragraph", "multiple_choice_question", "quiz"]
-    context: Optional[str] = None
+    context: str = DEFAULT_CONTEXT
+    stream: bool = False # Stream paragraph text as it is generated (text/plain) instead of returning JSON
+
+    @field_validator("context", mode="before")
+    @classmethod
+    def default_empty_context(cls, value: Optional[str]) -> str:
+        # Explicit null or "" also fall back to the default the prompts expect
+        return value if value else DEFAULT_CONTEXT
 
 @app.get("/")
 async def read_root():
@@ -282,50 +592,48 @@ async def read_root():
 @app.post("/generate")
 async def generate_content_endpoint(request: ContentRequest):
     """Endpoint logic using logging."""
+    # Reject immediately when the Gemini client isn't configured; callers below assume _MODEL is set
+    if _MODEL is None:
+        logger.error("Cannot call Gemini API: API key is not configured.")
+        raise HTTPException(status_code=503, detail="LLM not configured")
+
     # Log start of request processing
-    logger.info(f"Received generation request - Topic: '{request.topic}', Type: '{request.content_type}', Context: '{request.context}'")
-
-    prompt_template = None
-    parsing_function = None # Store the correct parsing function
-
-    # --- Select Prompt Template and Parser ---
-    if request.content_type == "paragraph":
-        logger.info("Routing to: Paragraph generation.") # logger.info
-        prompt_template = PARAGRAPH_PROMPT_TEMPLATE
-        # For paragraph, direct assignment is fine, but let's maintain pattern
-        def parse_paragraph(raw_text): # Simple inline parser for paragraph
-             logger.info("Parsing paragraph output.")
-             content = raw_text.strip()
-             if content:
-                  logger.info("Successfully parsed paragraph.")
-                  return {"type": "paragraph", "content": content}
-             else:
-                  logger.error("Paragraph Parsing Error: LLM returned empty text after stripping.")
-                  return None
-        parsing_function = parse_paragraph
-
-    elif request.content_type == "multiple_choice_question":
-        logger.info("Routing to: MCQ generation.") # logger.info
-        prompt_template = MCQ_PROMPT_TEMPLATE
-        parsing_function = parse_mcq_output # Use the dedicated function
-
-    elif request.content_type == "quiz":
-        logger.info("Routing to: Quiz generation.") # logger.info
-        prompt_template = QUIZ_PROMPT_TEMPLATE
-        parsing_function = parse_quiz_output # Use the dedicated function
+    logger.info("Received generation request - Topic: '%s', Type: '%s', Context: '%s'", request.topic, request.content_type, request.context)
 
-    else:
-        # Log invalid request info before raising exception
-        logger.warning(f"Invalid content_type received: {request.content_type}")
-        raise HTTPException(status_code=400, detail=f"Invalid content_type: '{request.content_type}'. Valid types are 'paragraph', 'multiple_choice_question', 'quiz'.")
+    # --- Select Parser ---
+    # content_type is already validated by the Literal type on ContentRequest
+    logger.info("Routing to: '%s' generation.", request.content_type) # logger.info
+    parsing_function = _PARSERS[request.content_type]
 
     # --- Format the Final Prompt ---
-    effective_context = request.context if request.context else "None provided."
-    final_prompt = prompt_template.format(topic=request.topic, context=effective_context)
+    final_prompt = _build_prompt(request.content_type, request.topic, request.context)
+    prompt_key = _prompt_key(_MODEL._model_name, final_prompt)
     # logger.debug(f"Formatted prompt:\n{final_prompt}") # DEBUG
 
+    # --- Stream Paragraphs on Request ---
+    # MCQ and quiz output must be complete before it can be parsed, so only paragraphs stream
+    if request.stream and request.content_type == "paragraph":
+        def cache_if_valid(text: str) -> None:
+            # Only cache text the non-streaming path would also accept
+            if parse_paragraph_output(text):
+                _response_cache_put(prompt_key, text)
+
+        chunks = stream_gemini(final_prompt, prompt_key, on_complete=cache_if_valid)
+        first_chunk = await anext(chunks, None) # Wait for the first chunk so failures still map to 503
+        if first_chunk is None:
+            logger.error("LLM streaming call failed or returned no content.")
+            raise HTTPException(status_code=503, detail="Failed to generate content using the LLM API. Check server logs.")
+
+        async def body():
+            yield first_chunk
+            async for chunk in chunks:
+                yield chunk
+
+        logger.info("Streaming paragraph response to client.")
+        return StreamingResponse(body(), media_type="text/plain")
+
     # --- Call the LLM ---
-    raw_llm_output = await call_gemini_api(final_prompt)
+    raw_llm_output, new_embedding = await generate_with_semantic_cache(final_prompt, prompt_key, request.content_type, request.topic, request.context)
 
     if raw_llm_output is None:
         # Error logged within call_gemini_api
@@ -333,15 +641,19 @@ async def generate_content_endpoint(request: ContentRequest):
         raise HTTPException(status_code=503, detail="Failed to generate content using the LLM API. Check server logs.")
 
     # --- Parse and Format Output ---
-    logger.info(f"Attempting to parse raw LLM output for type '{request.content_type}'...")
+    logger.info("Attempting to parse raw LLM output for type '%s'...", request.content_type)
     parsed_data = parsing_function(raw_llm_output) # Call the selected parser
 
     if parsed_data:
-        logger.info(f"Successfully processed request for '{request.content_type}'.")
+        # Cache only output that parsed, so a bad reply can be retried
+        _response_cache_put(prompt_key, raw_llm_output)
+        if new_embedding is not None:
+            _SEMANTIC_CACHE.add(request.content_type, new_embedding, raw_llm_output)
+        logger.info("Successfully processed request for '%s'.", request.content_type)
         return parsed_data # Return the successfully parsed and structured data
     else:
         # Error logged within the specific parsing function
-        logger.error(f"Parsing failed for content type '{request.content_type}'.")
+        logger.error("Parsing failed for content type '%s'.", request.content_type)
         raise HTTPException(
             status_code=500,
             detail=f"Server failed to parse the LLM output for '{request.content_type}'. Check server logs."